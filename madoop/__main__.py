@@ -4,7 +4,6 @@ Andrew DeOrio <awdeorio@umich.edu>
 
 """
 import argparse
-import importlib.metadata
 import logging
 import pathlib
 import shutil
@@ -14,8 +13,11 @@ from .mapreduce import mapreduce
 from .exceptions import MadoopError
 
 
-def main():
-    """Parse command line arguments and options then call mapreduce()."""
+def main(argv=None):
+    """Parse command line arguments and options then call mapreduce().
+
+    Parse argv, or sys.argv[1:] if argv is None.
+    """
     parser = argparse.ArgumentParser(
         description='A light weight MapReduce framework for education.'
     )
@@ -23,8 +25,8 @@ def main():
     optional_args = parser.add_argument_group('optional arguments')
 
     optional_args.add_argument(
-        '--version', action='version',
-        version=f'Madoop {importlib.metadata.version("madoop")}'
+        '--version', action=VersionAction, nargs=0,
+        help="show program's version number and exit",
     )
     optional_args.add_argument(
         '--example', action=ExampleAction, nargs=0,
@@ -43,13 +45,17 @@ def main():
         help=("executable that computes a partition for each key-value pair "
               "of map output: default is hash(key) %% num_reducers"),
     )
+    optional_args.add_argument(
+        '-combiner', dest='combiner', default=None,
+        help="executable that reduces the output of each mapper",
+    )
     required_args = parser.add_argument_group('required arguments')
     required_args.add_argument('-input', dest='input', required=True)
     required_args.add_argument('-output', dest='output', required=True)
     required_args.add_argument('-mapper', dest='mapper', required=True)
     required_args.add_argument('-reducer', dest='reducer', required=True)
 
-    args, _ = parser.parse_known_args()
+    args, _ = parser.parse_known_args(argv)
 
     # Handle verbose flag with logging configuration
     handler = logging.StreamHandler(sys.stdout)
@@ -71,11 +77,33 @@ def main():
             reduce_exe=args.reducer,
             num_reducers=int(args.num_reducers),
             partitioner=args.partitioner,
+            combiner=args.combiner,
         )
     except MadoopError as err:
         sys.exit(f"Error: {err}")
 
 
+class VersionAction(argparse.Action):
+    """Print version and exit.
+
+    Look up the installed package version only when the option is used, so
+    that every other invocation skips reading the package metadata.
+
+    Doc: https://docs.python.org/3/library/argparse.html#argparse.Action
+    """
+
+    # Python 3.6 pylint bug work around
+    # pylint: disable=too-few-public-methods
+
+    def __call__(self, parser, *args, **kwargs):
+        """Print version string."""
+        # importlib.metadata is slow to import and only needed here
+        # pylint: disable=import-outside-toplevel
+        import importlib.metadata
+        print(f'Madoop {importlib.metadata.version("madoop")}')
+        parser.exit()
+
+
 class ExampleAction(argparse.Action):
     """Copy example MapReduce program to PWD.
 
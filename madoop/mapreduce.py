@@ -5,19 +5,46 @@ Andrew DeOrio <awdeorio@umich.edu>
 """
 import contextlib
 import collections
+import errno
+import functools
 import hashlib
+import heapq
+import io
 import logging
+import math
+import mmap
+import os
 import pathlib
-import shutil
 import subprocess
 import tempfile
 import multiprocessing
 import concurrent.futures
 from .exceptions import MadoopError
 
+try:
+    import fcntl
+except ImportError:
+    # fcntl is Unix only
+    fcntl = None
 
-# Large input files are automatically split
-MAX_INPUT_SPLIT_SIZE = 10 * 1024 * 1024  # 10 MB
+
+# Input files larger than this are automatically split, into splits no smaller
+# than this
+MIN_INPUT_SPLIT_SIZE = 10 * 1024 * 1024  # 10 MB
+
+# Buffer size for data streamed through Python, like copies that can't be done
+# by the kernel and merges of sorted runs
+COPY_BUFSIZE = 1024 * 1024  # 1 MB
+
+# Pipe capacity for streaming input splits to mappers
+PIPE_SIZE = 1024 * 1024  # 1 MB
+
+# The group stage spills sorted runs to disk when its buffers exceed this size
+MAX_SORT_IN_MEMORY_SIZE = 256 * 1024 * 1024  # 256 MB
+
+# Executables that passed is_executable(), as (path, mode, mtime, ctime, size)
+# tuples.  ctime and mode change on chmod, which mtime doesn't.
+EXECUTABLE_CACHE = set()
 
 # Madoop logger
 LOGGER = logging.getLogger("madoop")
@@ -31,6 +58,7 @@ def mapreduce(
     reduce_exe,
     num_reducers,
     partitioner=None,
+    combiner=None,
 ):
     """Madoop API."""
     # pylint: disable=too-many-arguments
@@ -43,6 +71,8 @@ def mapreduce(
     # Executable scripts must have valid shebangs
     is_executable(map_exe)
     is_executable(reduce_exe)
+    if combiner is not None:
+        is_executable(combiner)
 
     # Create a tmp directory which will be automatically cleaned up
     with tempfile.TemporaryDirectory(prefix="madoop-") as tmpdir:
@@ -52,10 +82,8 @@ def mapreduce(
         # Create stage input and output directory
         map_output_dir = tmpdir/'mapper-output'
         reduce_input_dir = tmpdir/'reducer-input'
-        reduce_output_dir = tmpdir/'output'
         map_output_dir.mkdir()
         reduce_input_dir.mkdir()
-        reduce_output_dir.mkdir()
 
         # Copy and rename input files: part-00000, part-00001, etc.
         input_path = pathlib.Path(input_path)
@@ -63,6 +91,8 @@ def mapreduce(
         # Executables must be absolute paths
         map_exe = pathlib.Path(map_exe).resolve()
         reduce_exe = pathlib.Path(reduce_exe).resolve()
+        if combiner is not None:
+            combiner = pathlib.Path(combiner).resolve()
 
         # Run the mapping stage
         LOGGER.info("Starting map stage")
@@ -70,6 +100,7 @@ def mapreduce(
             exe=map_exe,
             input_dir=input_path,
             output_dir=map_output_dir,
+            combiner=combiner,
         )
 
         # Run the grouping stage
@@ -81,80 +112,156 @@ def mapreduce(
             partitioner=partitioner,
         )
 
-        # Run the reducing stage
+        # Run the reducing stage.  Reducers write directly to the
+        # user-specified output dir, which avoids copying the final output
+        # when the tmp directory is on a different filesystem.
         LOGGER.info("Starting reduce stage")
         reduce_stage(
             exe=reduce_exe,
             input_dir=reduce_input_dir,
-            output_dir=reduce_output_dir,
+            output_dir=output_dir,
         )
 
-        # Move files from temporary output dir to user-specified output dir
+    # Log output file sizes
+    if LOGGER.isEnabledFor(logging.DEBUG):
         total_size = 0
-        for filename in sorted(reduce_output_dir.glob("*")):
-            st_size = filename.stat().st_size
+        for entry in scandir_sorted(output_dir):
+            st_size = entry.stat().st_size
             total_size += st_size
-            shutil.move(filename, output_dir)
-            output_path = output_dir.parent/last_two(filename)
-            LOGGER.debug("%s size=%sB", output_path, st_size)
+            LOGGER.debug("%s size=%sB", entry.path, st_size)
+        LOGGER.debug("total output size=%sB", total_size)
 
     # Remind user where to find output
-    LOGGER.debug("total output size=%sB", total_size)
     LOGGER.info("Output directory: %s", output_dir)
 
 
+def input_split_size(filesize):
+    """Return the maximum split size for an input file of filesize bytes.
+
+    Splits grow with the square root of the file size, so that a very large
+    input doesn't start thousands of mappers.  This is the same heuristic that
+    Apache Beam uses.  Splits are never smaller than MIN_INPUT_SPLIT_SIZE.
+
+    Larger splits mean larger mapper output files, so each group stage worker
+    holds more memory while partitioning a file.  See partition_files().
+
+    """
+    return max(MIN_INPUT_SPLIT_SIZE, int(1000 * math.sqrt(filesize)))
+
+
 def split_file(input_filename, max_chunksize):
-    """Iterate over the data in a file one chunk at a time."""
+    """Iterate over the chunks of a file, yielding (offset, size) pairs.
+
+    We don't want a chunk that ends in the middle of a line; we have to
+    respect line boundaries or we'll corrupt the input.  Each chunk ends at
+    the last newline within max_chunksize bytes, unless a single line is
+    longer than that, in which case the chunk is extended to the end of the
+    line.  The file is memory-mapped so that searching for newlines doesn't
+    copy the data into Python objects.
+
+    """
     with open(input_filename, "rb") as input_file:
-        buffer = b""
+        filesize = os.fstat(input_file.fileno()).st_size
+        # mmap can't map an empty file
+        if not filesize:
+            return
+        with mmap.mmap(
+            input_file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            offset = 0
+            while offset < filesize:
+                end = min(offset + max_chunksize, filesize)
+                newline = data.rfind(b"\n", offset, end)
+                if newline == -1:
+                    newline = data.find(b"\n", end)
+                if newline == -1:
+                    newline = filesize - 1
+                yield offset, newline + 1 - offset
+                offset = newline + 1
+
+
+def set_pipe_size(pipe, size):
+    """Try to set the capacity of pipe, which is only possible on Linux.
+
+    A larger pipe lets each copy into it move more data before the reader has
+    to catch up, reducing system calls and context switches.
 
-        while True:
-            chunk = input_file.read(max_chunksize)
-            # Break if no more data remains.
-            if not chunk:
-                break
+    """
+    if fcntl is None:
+        return
+    try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, size)
+    except (AttributeError, OSError):
+        # F_SETPIPE_SZ is Linux only and the size may exceed the user limit
+        pass
 
-            # Add the chunk to the buffer.
-            buffer += chunk
 
-            # Find the last newline character in the buffer. We don't want to
-            # yield a chunk that ends in the middle of a line; we have to
-            # respect line boundaries or we'll corrupt the input.
-            last_newline = buffer.rfind(b"\n")
-            if last_newline != -1:
-                # Yield the content up to the last newline, saving the rest
-                # for the next chunk.
-                yield buffer[:last_newline + 1]
+def copy_file_range(infile, outfile, offset, size):
+    """Copy size bytes starting at offset from infile to outfile.
 
-                # Remove processed data from the buffer. The next chunk will
-                # start with whatever data came after the last newline.
-                buffer = buffer[last_newline + 1:]
+    Use os.sendfile() when the platform supports it for these file types, so
+    the data is copied by the kernel without passing through Python.
 
-        # Yield any remaining data.
-        if buffer:
-            yield buffer
+    """
+    infd = infile.fileno()
+    outfd = outfile.fileno()
+    try:
+        while size > 0:
+            sent = os.sendfile(outfd, infd, offset, size)
+            if not sent:
+                return
+            offset += sent
+            size -= sent
+        return
+    except (AttributeError, OSError) as err:
+        # Fall back to read and write, e.g., macOS only supports sockets.  We
+        # still haven't sent anything if sendfile() isn't supported.
+        if isinstance(err, OSError) and err.errno not in (
+            errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP,
+        ):
+            raise
+    infile.seek(offset)
+    while size > 0:
+        data = infile.read(min(size, COPY_BUFSIZE))
+        if not data:
+            return
+        outfile.write(data)
+        size -= len(data)
 
 
 def normalize_input_paths(input_path):
-    """Return a list of filtered input files.
+    """Return a list of filtered input files as (path, size) pairs.
 
     If input_path is a file, then use it.  If input_path is a directory, then
-    grab all the *files* inside.  Ignore subdirectories.
+    grab all the *files* inside.  Ignore subdirectories.  Each file is stat'ed
+    once, so callers don't need to stat it again for its size.
 
     """
     input_paths = []
     if input_path.is_dir():
-        for path in sorted(input_path.glob('*')):
-            if path.is_file():
-                input_paths.append(path)
+        for entry in scandir_sorted(input_path):
+            path = input_path/entry.name
+            if entry.is_file():
+                input_paths.append((path, entry.stat().st_size))
             else:
                 LOGGER.warning("Ignoring non-file: %s", path)
     elif input_path.is_file():
-        input_paths.append(input_path)
+        input_paths.append((input_path, input_path.stat().st_size))
     assert input_paths, f"No input: {input_path}"
     return input_paths
 
 
+def scandir_sorted(path):
+    """Return the os.DirEntry objects in directory path, sorted by name.
+
+    Unlike pathlib, DirEntry objects cache file type and stat information, so
+    callers can check them without extra system calls.
+
+    """
+    with os.scandir(path) as entries:
+        return sorted(entries, key=lambda entry: entry.name)
+
+
 def is_executable(exe):
     """Verify exe is executable and raise exception if it is not.
 
@@ -162,11 +269,24 @@ def is_executable(exe):
     can't just check the executable bit because scripts with incorrect shebangs
     result in difficult-to-understand error messages.
 
+    Remember executables that pass, so an unchanged exe isn't executed again
+    by later calls in the same process.
+
     """
     exe = pathlib.Path(exe).resolve()
     try:
+        exe_stat = exe.stat()
+        key = (
+            exe,
+            exe_stat.st_mode,
+            exe_stat.st_mtime_ns,
+            exe_stat.st_ctime_ns,
+            exe_stat.st_size,
+        )
+        if key in EXECUTABLE_CACHE:
+            return
         subprocess.run(
-            str(exe),
+            [str(exe)],
             shell=False,
             input="".encode(),
             stdout=subprocess.PIPE,
@@ -175,6 +295,7 @@ def is_executable(exe):
         )
     except (subprocess.CalledProcessError, OSError) as err:
         raise MadoopError(f"Failed executable test: {err}") from err
+    EXECUTABLE_CACHE.add(key)
 
 
 def part_filename(num):
@@ -188,17 +309,50 @@ def part_filename(num):
     return f"part-{num:05d}"
 
 
-def map_single_chunk(exe, input_path, output_path, chunk):
-    """Execute mapper on a single chunk."""
-    with output_path.open("w") as outfile:
+def map_single_chunk(exe, input_path, output_path, chunk, combiner=None):
+    """Execute mapper on a single chunk.
+
+    chunk is an (offset, size) pair from split_file().  The chunk is streamed
+    from input_path to the mapper's stdin, so it is never held in memory.  If
+    chunk is None, the mapper reads all of input_path directly.  If combiner
+    is not None, the mapper output is then combined in place.
+
+    """
+    map_chunk(exe, input_path, output_path, chunk)
+    if combiner is not None:
+        combine_single_file(combiner, output_path)
+
+
+def map_chunk(exe, input_path, output_path, chunk):
+    """Run mapper on a single chunk, writing its output to output_path."""
+    with input_path.open("rb") as infile, output_path.open("wb") as outfile:
         try:
-            subprocess.run(
-                str(exe),
+            if chunk is None:
+                subprocess.run(
+                    [str(exe)],
+                    shell=False,
+                    check=True,
+                    stdin=infile,
+                    stdout=outfile,
+                )
+                return
+            with subprocess.Popen(
+                [str(exe)],
                 shell=False,
-                check=True,
-                input=chunk,
+                stdin=subprocess.PIPE,
                 stdout=outfile,
-            )
+            ) as process:
+                set_pipe_size(process.stdin, PIPE_SIZE)
+                try:
+                    copy_file_range(infile, process.stdin, *chunk)
+                except BrokenPipeError:
+                    # The mapper exited without reading all of its input.
+                    # Its exit status tells us whether that was an error.
+                    pass
+                finally:
+                    process.stdin.close()
+            if process.returncode:
+                raise subprocess.CalledProcessError(process.returncode, exe)
         except (subprocess.CalledProcessError, OSError) as err:
             raise MadoopError(
                 f"Command returned non-zero: "
@@ -206,215 +360,483 @@ def map_single_chunk(exe, input_path, output_path, chunk):
             ) from err
 
 
-def map_stage(exe, input_dir, output_dir):
-    """Execute mappers."""
+def combine_single_file(exe, path):
+    """Replace the mapper output in path with its sorted, combined output.
+
+    A combiner is a reducer that runs on the output of a single mapper.  It
+    reduces the amount of data that the group stage has to partition and
+    sort.
+
+    """
+    tmp_path = path.with_name(path.name + ".combined")
+    with contextlib.ExitStack() as stack:
+        lines = sorted_file_lines(path, stack)
+        outfile = stack.enter_context(tmp_path.open("wb"))
+        try:
+            with subprocess.Popen(
+                [str(exe)],
+                shell=False,
+                stdin=subprocess.PIPE,
+                stdout=outfile,
+            ) as process:
+                process.stdin.writelines(lines)
+        except BrokenPipeError:
+            # The combiner exited without reading all of its input.  Closing
+            # stdin on exit flushes its buffer and fails again, but Popen
+            # still waits for the combiner, whose exit status tells us whether
+            # that was an error.
+            pass
+        except OSError as err:
+            raise MadoopError(
+                f"Command returned non-zero: {exe} < {path} > {path}"
+            ) from err
+        if process.returncode:
+            raise MadoopError(
+                f"Command returned non-zero: {exe} < {path} > {path}"
+            )
+    os.replace(tmp_path, path)
+
+
+def sorted_file_lines(path, stack):
+    """Return an iterable over the sorted lines of path.
+
+    Sort at most MAX_SORT_IN_MEMORY_SIZE bytes of path in memory.  A larger
+    file is sorted in pieces that are spilled to run files next to path and
+    merged lazily.  The open files belong to stack, an ExitStack.
+
+    """
+    infile = stack.enter_context(path.open("rb", buffering=COPY_BUFSIZE))
+    lines = read_sorted_lines(infile)
+    if not infile.peek(1):
+        return lines
+    # The ExitStack cleans up the run directory
+    # pylint: disable=consider-using-with
+    run_dir = pathlib.Path(stack.enter_context(
+        tempfile.TemporaryDirectory(prefix="runs-", dir=path.parent)
+    ))
+    run_paths = []
+    while lines:
+        run_path = run_dir/f"{len(run_paths):05d}"
+        with run_path.open("wb") as outfile:
+            outfile.write(b"".join(lines))
+        run_paths.append(run_path)
+        lines = read_sorted_lines(infile)
+    return heapq.merge(*[
+        stack.enter_context(p.open("rb", buffering=COPY_BUFSIZE))
+        for p in run_paths
+    ])
+
+
+def read_sorted_lines(infile):
+    """Read about MAX_SORT_IN_MEMORY_SIZE bytes of lines and sort them."""
+    lines = infile.readlines(MAX_SORT_IN_MEMORY_SIZE)
+    if lines and not lines[-1].endswith(b"\n"):
+        lines[-1] += b"\n"
+    lines.sort()
+    return lines
+
+
+def wait_for_futures(futures):
+    """Wait for futures, raising the first exception.
+
+    When any future fails, the ones that haven't started yet are cancelled, so
+    a bad mapper or reducer doesn't wait for the rest of the queue.
+
+    """
+    done, not_done = concurrent.futures.wait(
+        futures,
+        return_when=concurrent.futures.FIRST_EXCEPTION,
+    )
+    for future in not_done:
+        future.cancel()
+    for future in futures:
+        if future in done and future.exception():
+            raise future.exception()
+
+
+def map_stage(exe, input_dir, output_dir, combiner=None):
+    """Execute mappers, and combiners if combiner is not None."""
     part_num = 0
     futures = []
+    debug = LOGGER.isEnabledFor(logging.DEBUG)
     with concurrent.futures.ThreadPoolExecutor(
         max_workers=multiprocessing.cpu_count()
     ) as pool:
-        for input_path in normalize_input_paths(input_dir):
-            for chunk in split_file(input_path, MAX_INPUT_SPLIT_SIZE):
+        for input_path, st_size in normalize_input_paths(input_dir):
+            # Files that don't need splitting are read by the mapper directly
+            if st_size > MIN_INPUT_SPLIT_SIZE:
+                chunks = split_file(input_path, input_split_size(st_size))
+            else:
+                chunks = [None] if st_size else []
+            for chunk in chunks:
                 output_path = output_dir/part_filename(part_num)
-                LOGGER.debug(
-                    "%s < %s > %s",
-                    exe.name, last_two(input_path), last_two(output_path),
-                )
+                if debug:
+                    LOGGER.debug(
+                        "%s < %s > %s",
+                        exe.name, last_two(input_path), last_two(output_path),
+                    )
+                    if combiner is not None:
+                        LOGGER.debug(
+                            "combine %s with %s",
+                            last_two(output_path), combiner.name,
+                        )
                 futures.append(pool.submit(
                     map_single_chunk,
                     exe,
                     input_path,
                     output_path,
                     chunk,
+                    combiner,
                 ))
                 part_num += 1
-    for future in concurrent.futures.as_completed(futures):
-        exception = future.exception()
-        if exception:
-            raise exception
+        wait_for_futures(futures)
     LOGGER.info("Finished map executions: %s", part_num)
 
 
-def sort_file(path):
-    """Sort contents of path, overwriting it."""
-    LOGGER.debug("sort %s", last_two(path))
-    with path.open() as infile:
-        sorted_lines = sorted(infile)
-    with path.open("w") as outfile:
-        outfile.writelines(sorted_lines)
+def keyhash(key):
+    """Hash key and return an integer.
 
+    Convert the digest bytes directly rather than round-tripping through a
+    hex string.  The result is the same integer either way.
 
-def keyhash(key):
-    """Hash key and return an integer."""
-    hexdigest = hashlib.md5(key.encode("utf-8")).hexdigest()
-    return int(hexdigest, base=16)
+    """
+    return int.from_bytes(hashlib.md5(key).digest(), "big")
 
 
 def partition_keys_default(
         inpath,
+        buckets,
         outpaths,
         input_keys_stats,
         output_keys_stats,
         num_reducers):
-    """Allocate lines of inpath among outpaths using hash of key.
+    """Allocate lines of inpath among buckets using hash of key.
 
-    Update the data structures provided by the caller input_keys_stats and
-    output_keys_stats.  Both map a filename to a set of of keys.
+    Read the whole input file as bytes and append each line to the bytearray
+    in buckets that corresponds to its output file in outpaths.  Update the
+    data structures provided by the caller input_keys_stats and
+    output_keys_stats.  Both map a filename to a set of of keys.  Skip key
+    tracking when they are None.
     """
-    assert len(outpaths) == num_reducers
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-positional-arguments
+    assert len(outpaths) == len(buckets) == num_reducers
     outparent = outpaths[0].parent
     assert all(i.parent == outparent for i in outpaths)
-    with contextlib.ExitStack() as stack:
-        outfiles = [stack.enter_context(p.open("a")) for p in outpaths]
-        for line in stack.enter_context(inpath.open()):
-            key = line.partition('\t')[0]
-            input_keys_stats[inpath].add(key)
-            reducer_idx = keyhash(key) % num_reducers
-            outfiles[reducer_idx].write(line)
-            outpath = outpaths[reducer_idx]
-            output_keys_stats[outpath].add(key)
+    track_keys = input_keys_stats is not None
+    # Select the low bits of the hash when num_reducers is a power of two
+    mask = num_reducers - 1 if num_reducers & (num_reducers - 1) == 0 else 0
+    with inpath.open("rb") as infile:
+        lines = infile.readlines()
+    if lines and not lines[-1].endswith(b"\n"):
+        lines[-1] += b"\n"
+    # Keys often repeat, so remember each key's partition instead of hashing
+    # it again
+    reducer_idxs = {}
+    for line in lines:
+        key = line.partition(b'\t')[0]
+        reducer_idx = reducer_idxs.get(key)
+        if reducer_idx is None:
+            if mask:
+                reducer_idx = keyhash(key) & mask
+            else:
+                reducer_idx = keyhash(key) % num_reducers
+            reducer_idxs[key] = reducer_idx
+            # Record each key's stats once, when it is first seen
+            if track_keys:
+                input_keys_stats[inpath].add(key)
+                output_keys_stats[outpaths[reducer_idx]].add(key)
+        buckets[reducer_idx] += line
 
 
 def partition_keys_custom(
     inpath,
+    buckets,
     outpaths,
     input_keys_stats,
     output_keys_stats,
     num_reducers,
     partitioner,
 ):
-    """Allocate lines of inpath among outpaths using a custom partitioner.
+    """Allocate lines of inpath among buckets using a custom partitioner.
 
-    Update the data structures provided by the caller input_keys_stats and
-    output_keys_stats.  Both map a filename to a set of of keys.
+    Append each line to the bytearray in buckets that corresponds to its
+    output file in outpaths.  Update the data structures provided by the
+    caller input_keys_stats and output_keys_stats.  Both map a filename to a
+    set of of keys.  Skip key tracking when they are None.
     """
     # pylint: disable=too-many-arguments
     # pylint: disable=too-many-positional-arguments
     # pylint: disable=too-many-locals
-    assert len(outpaths) == num_reducers
+    assert len(outpaths) == len(buckets) == num_reducers
     outparent = outpaths[0].parent
     assert all(i.parent == outparent for i in outpaths)
-    with contextlib.ExitStack() as stack:
-        outfiles = [stack.enter_context(p.open("a")) for p in outpaths]
-        process = stack.enter_context(subprocess.Popen(
-            [partitioner, str(num_reducers)],
-            stdin=stack.enter_context(inpath.open()),
-            stdout=subprocess.PIPE,
-            text=True,
-        ))
-        for line, partition in zip(
-            stack.enter_context(inpath.open()),
-            stack.enter_context(process.stdout)
-        ):
-            try:
-                partition = int(partition)
-            except ValueError as err:
-                raise MadoopError(
-                     "Partition executable returned non-integer value: "
-                     f"{partition} for line '{line}'."
-                ) from err
-            if not 0 <= partition < num_reducers:
-                raise MadoopError(
-                     "Partition executable returned invalid value: "
-                     f"0 <= {partition} < {num_reducers} for line '{line}'."
-                )
-            key = line.partition('\t')[0]
-            input_keys_stats[inpath].add(key)
-            outfiles[partition].write(line)
-            outpath = outpaths[partition]
-            output_keys_stats[outpath].add(key)
-
-        return_code = process.wait()
-        if return_code:
+    track_keys = input_keys_stats is not None
+    # Read the input once and feed the same copy to the partitioner.
+    # communicate() writes stdin and drains stdout concurrently.
+    data = inpath.read_bytes()
+    with subprocess.Popen(
+        [partitioner, str(num_reducers)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    ) as process:
+        stdout, _ = process.communicate(data)
+    for line, partition in zip(
+        io.BytesIO(data).readlines(),
+        io.BytesIO(stdout).readlines(),
+    ):
+        try:
+            partition = int(partition)
+        except ValueError as err:
+            raise MadoopError(
+                 "Partition executable returned non-integer value: "
+                 f"{partition.decode(errors='replace')} for line "
+                 f"'{line.decode(errors='replace')}'."
+            ) from err
+        if not 0 <= partition < num_reducers:
             raise MadoopError(
-                f"Partition executable returned non-zero: {str(partitioner)}"
+                 "Partition executable returned invalid value: "
+                 f"0 <= {partition} < {num_reducers} for line "
+                 f"'{line.decode(errors='replace')}'."
             )
+        if not line.endswith(b"\n"):
+            line += b"\n"
+        buckets[partition] += line
+        if track_keys:
+            key = line.partition(b'\t')[0]
+            input_keys_stats[inpath].add(key)
+            output_keys_stats[outpaths[partition]].add(key)
+
+    if process.returncode:
+        raise MadoopError(
+            f"Partition executable returned non-zero: {str(partitioner)}"
+        )
 
 
 def log_input_key_stats(input_keys_stats, input_dir):
     """Log input key stats."""
-    all_input_keys = set()
     for inpath, keys in sorted(input_keys_stats.items()):
-        all_input_keys.update(keys)
         LOGGER.debug("%s unique_keys=%s", last_two(inpath), len(keys))
+    all_input_keys = set().union(*input_keys_stats.values())
     LOGGER.debug("%s all_unique_keys=%s", input_dir.name, len(all_input_keys))
 
 
 def log_output_key_stats(output_keys_stats, output_dir):
     """Log output keyspace stats."""
-    all_output_keys = set()
     for outpath, keys in sorted(output_keys_stats.items()):
-        all_output_keys.update(keys)
         LOGGER.debug("%s unique_keys=%s", last_two(outpath), len(keys))
+    all_output_keys = set().union(*output_keys_stats.values())
     LOGGER.debug("%s all_unique_keys=%s", output_dir.name,
                  len(all_output_keys))
 
 
-def group_stage(input_dir, output_dir, num_reducers, partitioner):
-    """Run group stage.
+def partition_file(inpath, outpaths, partitioner, track_keys):
+    """Partition one mapper output file into a new list of buckets.
 
-    Process each mapper output file, allocating lines to grouper output files
-    using the hash and modulo of the key.
+    Return the buckets along with the input and output key stats, which are
+    None unless track_keys is set.  This function runs in a worker process.
+
+    Each bucket is returned sorted.  Sorting here spreads the work across the
+    worker processes, and the final sort in the parent is much faster because
+    Python's sort merges the presorted runs that it finds in its input.
 
     """
-    # Compute output filenames
-    LOGGER.debug("%s reducers", num_reducers)
-    outpaths = []
-    for i in range(num_reducers):
-        outpaths.append(output_dir/part_filename(i))
-
-    # Track keyspace stats, map filename -> set of keys
-    input_keys_stats = collections.defaultdict(set)
-    output_keys_stats = collections.defaultdict(set)
-
-    # Partition input, appending to output files
-    for inpath in sorted(input_dir.iterdir()):
-        if not partitioner:
-            partition_keys_default(inpath, outpaths, input_keys_stats,
-                                   output_keys_stats, num_reducers)
-        else:
-            partition_keys_custom(inpath, outpaths, input_keys_stats,
-                                  output_keys_stats, num_reducers, partitioner)
-
-    log_input_key_stats(input_keys_stats, input_dir)
-
-    # Log partition input and output filenames
-    outnames = [i.name for i in outpaths]
+    buckets = [bytearray() for _ in outpaths]
+    input_keys_stats = collections.defaultdict(set) if track_keys else None
+    output_keys_stats = collections.defaultdict(set) if track_keys else None
+    if partitioner:
+        partition_keys_custom(inpath, buckets, outpaths, input_keys_stats,
+                              output_keys_stats, len(outpaths), partitioner)
+    else:
+        partition_keys_default(inpath, buckets, outpaths, input_keys_stats,
+                               output_keys_stats, len(outpaths))
+    buckets = [sort_lines(bucket) for bucket in buckets]
+    return buckets, input_keys_stats, output_keys_stats
+
+
+def partition_files(inpaths, outpaths, partitioner, track_keys):
+    """Partition mapper output files in parallel.
+
+    Yield the result of partition_file() for each of inpaths, in order.
+    Each result holds a whole file's buckets, so at most one result per
+    worker is in flight.  The next file is submitted only after the caller
+    consumes a result.
+
+    This limits the number of results, not their size, and none of it counts
+    against MAX_SORT_IN_MEMORY_SIZE.  Each worker holds its whole input file
+    in memory, along with the buckets and their sorted copies, a few times
+    the size of the file.  Peak memory is roughly processes * mapper output
+    file size * that overhead, plus the result that the caller is adding to
+    its buckets.
+
+    """
+    func = functools.partial(
+        partition_file,
+        outpaths=outpaths,
+        partitioner=partitioner,
+        track_keys=track_keys,
+    )
+    if len(inpaths) < 2:
+        yield from map(func, inpaths)
+        return
+
+    # Don't use a with statement here, because Coverage won't be able to
+    # detect code running in a subprocess if we do.
+    # https://pytest-cov.readthedocs.io/en/latest/subprocess-support.html
+    # pylint: disable=consider-using-with
+    processes = min(len(inpaths), multiprocessing.cpu_count())
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        pending = collections.deque(
+            pool.apply_async(func, (inpath,))
+            for inpath in inpaths[:processes]
+        )
+        for inpath in inpaths[processes:]:
+            result = pending.popleft().get()
+            pending.append(pool.apply_async(func, (inpath,)))
+            yield result
+        while pending:
+            yield pending.popleft().get()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+
+def add_partition_result(
+        result, buckets, input_keys_stats, output_keys_stats):
+    """Add the buckets and key stats from partition_file() to the totals."""
+    file_buckets, file_input_keys_stats, file_output_keys_stats = result
+    for bucket, file_bucket in zip(buckets, file_buckets):
+        bucket += file_bucket
+    if input_keys_stats is not None:
+        input_keys_stats.update(file_input_keys_stats)
+        for outpath, keys in file_output_keys_stats.items():
+            output_keys_stats[outpath].update(keys)
+
+
+def sort_lines(data):
+    """Return the lines in data, sorted and joined."""
+    lines = io.BytesIO(data).readlines()
+    lines.sort()
+    return b"".join(lines)
+
+
+def write_sorted_bucket(bucket, path):
+    """Sort the lines in bucket, write them to path and empty bucket."""
+    lines = io.BytesIO(bucket).readlines()
+    bucket.clear()
+    lines.sort()
+    # One large write is much faster than buffering each line
+    with path.open("wb") as outfile:
+        outfile.write(b"".join(lines))
+
+
+def spill_buckets(buckets, runs, run_dir):
+    """Write each non-empty bucket to a new sorted run file in run_dir.
+
+    Append the run filename to the list in runs for the bucket's partition.
+
+    """
+    for i, (bucket, run_paths) in enumerate(zip(buckets, runs)):
+        if bucket:
+            run_path = run_dir/f"{part_filename(i)}.{len(run_paths):05d}"
+            write_sorted_bucket(bucket, run_path)
+            run_paths.append(run_path)
+
+
+def merge_runs(run_paths, outpath):
+    """Merge sorted run files into outpath, streaming one line at a time."""
+    with contextlib.ExitStack() as stack:
+        infiles = [
+            stack.enter_context(p.open("rb", buffering=COPY_BUFSIZE))
+            for p in run_paths
+        ]
+        outfile = stack.enter_context(
+            outpath.open("wb", buffering=COPY_BUFSIZE)
+        )
+        outfile.writelines(heapq.merge(*infiles))
+
+
+def log_partition_filenames(inpaths, outpaths):
+    """Log partition input and output filenames."""
+    outnames = ",".join(i.name for i in outpaths)
     outparent = outpaths[0].parent
-    for inpath in sorted(input_keys_stats.keys()):
+    for inpath in inpaths:
         LOGGER.debug(
             "partition %s >> %s/{%s}",
-            last_two(inpath), outparent.name, ",".join(outnames),
+            last_two(inpath), outparent.name, outnames,
         )
 
-    # Remove empty output files.  We won't always use the maximum number of
-    # reducers because some MapReduce programs have fewer intermediate keys.
-    for path in sorted(output_dir.iterdir()):
-        if path.stat().st_size == 0:
-            LOGGER.debug("empty partition: rm %s", last_two(path))
-            path.unlink()
 
-    # Sort output files
-    try:
-        # Don't use a with statement here, because Coverage won't be able to
-        # detect code running in a subprocess if we do.
-        # https://pytest-cov.readthedocs.io/en/latest/subprocess-support.html
-        # pylint: disable=consider-using-with
-        pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-        pool.map(sort_file, sorted(output_dir.iterdir()))
-    finally:
-        pool.close()
-        pool.join()
+def write_partitions(buckets, runs, outpaths, run_dir):
+    """Write sorted output files from in-memory buckets and run files.
+
+    We won't always use the maximum number of reducers because some MapReduce
+    programs have fewer intermediate keys, so empty partitions don't produce
+    output files.
+
+    """
+    if any(runs):
+        spill_buckets(buckets, runs, run_dir)
+    for outpath, bucket, run_paths in zip(outpaths, buckets, runs):
+        if run_paths:
+            merge_runs(run_paths, outpath)
+        elif bucket:
+            write_sorted_bucket(bucket, outpath)
+        elif LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("empty partition: %s", last_two(outpath))
+
+
+def group_stage(input_dir, output_dir, num_reducers, partitioner):
+    """Run group stage.
+
+    Process each mapper output file, allocating lines to grouper output files
+    using the hash and modulo of the key, or a custom partitioner.  Lines are
+    buffered in memory, one bucket per output file.  When the input is small
+    enough, sort each bucket and write its output file exactly once.
+    Otherwise, spill the buckets to sorted run files whenever they grow too
+    large, and merge the runs of each partition at the end.
+
+    """
+    # Compute output filenames
+    LOGGER.debug("%s reducers", num_reducers)
+    outpaths = [output_dir/part_filename(i) for i in range(num_reducers)]
+
+    # Track keyspace stats, map filename -> set of keys.  Tracking every key
+    # is expensive, so only do it when the stats will be logged.
+    debug = LOGGER.isEnabledFor(logging.DEBUG)
+    input_keys_stats = collections.defaultdict(set) if debug else None
+    output_keys_stats = collections.defaultdict(set) if debug else None
+
+    # Partition input.  runs maps each partition to its sorted run files.
+    inpaths = [input_dir/i.name for i in scandir_sorted(input_dir)]
+    buckets = [bytearray() for _ in outpaths]
+    runs = [[] for _ in outpaths]
+    with tempfile.TemporaryDirectory(prefix="runs-", dir=output_dir) as tmp:
+        for result in partition_files(inpaths, outpaths, partitioner, debug):
+            add_partition_result(
+                result, buckets, input_keys_stats, output_keys_stats,
+            )
+            if sum(len(i) for i in buckets) > MAX_SORT_IN_MEMORY_SIZE:
+                spill_buckets(buckets, runs, pathlib.Path(tmp))
 
-    log_output_key_stats(output_keys_stats, output_dir)
+        write_partitions(buckets, runs, outpaths, pathlib.Path(tmp))
+
+    if debug:
+        log_input_key_stats(input_keys_stats, input_dir)
+        log_partition_filenames(inpaths, outpaths)
+        log_output_key_stats(output_keys_stats, output_dir)
 
 
 def reduce_single_file(exe, input_path, output_path):
     """Execute reducer on a single file."""
-    with input_path.open() as infile, output_path.open("w") as outfile:
+    with input_path.open("rb") as infile, output_path.open("wb") as outfile:
         try:
             subprocess.run(
-                str(exe),
+                [str(exe)],
                 shell=False,
                 check=True,
                 stdin=infile,
@@ -428,29 +850,42 @@ def reduce_single_file(exe, input_path, output_path):
 
 
 def reduce_stage(exe, input_dir, output_dir):
-    """Execute reducers."""
-    i = 0
+    """Execute reducers.
+
+    Reducers write directly to output_dir.  If any reducer fails, remove the
+    output files of all of them, so a failed job doesn't leave partial output
+    behind.
+
+    """
     futures = []
-    with concurrent.futures.ThreadPoolExecutor(
-        max_workers=multiprocessing.cpu_count()
-    ) as pool:
-        for i, input_path in enumerate(sorted(input_dir.iterdir())):
-            output_path = output_dir/part_filename(i)
-            LOGGER.debug(
-                "%s < %s > %s",
-                exe.name, last_two(input_path), last_two(output_path),
-            )
-            futures.append(pool.submit(
-                reduce_single_file,
-                exe,
-                input_path,
-                output_path,
-            ))
-    for future in concurrent.futures.as_completed(futures):
-        exception = future.exception()
-        if exception:
-            raise exception
-    LOGGER.info("Finished reduce executions: %s", i+1)
+    output_paths = []
+    debug = LOGGER.isEnabledFor(logging.DEBUG)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=multiprocessing.cpu_count()
+        ) as pool:
+            for i, entry in enumerate(scandir_sorted(input_dir)):
+                input_path = input_dir/entry.name
+                output_path = output_dir/part_filename(i)
+                if debug:
+                    LOGGER.debug(
+                        "%s < %s > %s",
+                        exe.name, last_two(input_path), last_two(output_path),
+                    )
+                output_paths.append(output_path)
+                futures.append(pool.submit(
+                    reduce_single_file,
+                    exe,
+                    input_path,
+                    output_path,
+                ))
+            wait_for_futures(futures)
+    except BaseException:
+        # The pool has waited for the reducers that were already running
+        for output_path in output_paths:
+            output_path.unlink(missing_ok=True)
+        raise
+    LOGGER.info("Finished reduce executions: %s", len(futures))
 
 
 def last_two(path):
@@ -1,5 +1,5 @@
 """System tests for the API interface."""
-from pathlib import Path
+import shutil
 import pytest
 import madoop
 from madoop.mapreduce import map_stage, reduce_stage
@@ -7,75 +7,117 @@ from . import utils
 from .utils import TESTDATA_DIR
 
 
-def test_simple(tmpdir):
-    """Run a simple MapReduce job and verify the output."""
-    with tmpdir.as_cwd():
-        madoop.mapreduce(
-            input_path=TESTDATA_DIR/"word_count/input",
-            output_dir="output",
-            map_exe=TESTDATA_DIR/"word_count/map.py",
-            reduce_exe=TESTDATA_DIR/"word_count/reduce.py",
-            num_reducers=4,
-            partitioner=None,
-        )
+@pytest.mark.parametrize(
+    "input_path, map_exe, reduce_exe",
+    [
+        pytest.param(
+            "word_count/input", "word_count/map.py", "word_count/reduce.py",
+            id="simple",
+        ),
+        # MapReduce job written in Bash
+        pytest.param(
+            "word_count/input", "word_count/map.sh", "word_count/reduce.sh",
+            id="bash",
+            marks=pytest.mark.skipif(
+                shutil.which("/bin/bash") is None, reason="requires bash",
+            ),
+        ),
+        # Empty input files should not raise an error
+        pytest.param(
+            "word_count/input_empty",
+            "word_count/map.py",
+            "word_count/reduce.py",
+            id="empty-inputs",
+        ),
+        # Input file instead of dir
+        pytest.param(
+            "word_count/input-single-file.txt",
+            "word_count/map.py",
+            "word_count/reduce.py",
+            id="single-input-file",
+        ),
+        # Subdirectories of the input directory should be ignored
+        pytest.param(
+            "word_count/input_with_subdir",
+            "word_count/map.py",
+            "word_count/reduce.py",
+            id="ignores-subdirs",
+        ),
+        pytest.param(
+            "word_count SPACE/input SPACE",
+            "word_count SPACE/map SPACE.py",
+            "word_count SPACE/reduce SPACE.py",
+            id="input-path-spaces",
+        ),
+    ],
+)
+def test_word_count(tmp_path, input_path, map_exe, reduce_exe):
+    """Run word count jobs that all produce the same output."""
+    madoop.mapreduce(
+        input_path=TESTDATA_DIR/input_path,
+        output_dir=tmp_path/"output",
+        map_exe=TESTDATA_DIR/map_exe,
+        reduce_exe=TESTDATA_DIR/reduce_exe,
+        num_reducers=4,
+        partitioner=None,
+    )
     utils.assert_dirs_eq(
         TESTDATA_DIR/"word_count/correct/output",
-        tmpdir/"output",
+        tmp_path/"output",
     )
 
 
-def test_2_reducers(tmpdir):
-    """Run a simple MapReduce job with 2 reducers."""
-    with tmpdir.as_cwd():
-        madoop.mapreduce(
-            input_path=TESTDATA_DIR/"word_count/input",
-            output_dir="output",
-            map_exe=TESTDATA_DIR/"word_count/map.py",
-            reduce_exe=TESTDATA_DIR/"word_count/reduce.py",
-            num_reducers=2,
-            partitioner=None,
-        )
+def test_combiner(tmp_path):
+    """Run a simple MapReduce job with a combiner."""
+    madoop.mapreduce(
+        input_path=TESTDATA_DIR/"word_count/input",
+        output_dir=tmp_path/"output",
+        map_exe=TESTDATA_DIR/"word_count/map.py",
+        reduce_exe=TESTDATA_DIR/"word_count/reduce.py",
+        num_reducers=4,
+        partitioner=None,
+        combiner=TESTDATA_DIR/"word_count/combine.py",
+    )
     utils.assert_dirs_eq(
-        TESTDATA_DIR/"word_count/correct/output-2-reducers",
-        tmpdir/"output",
+        TESTDATA_DIR/"word_count/correct/output",
+        tmp_path/"output",
     )
 
 
-def test_bash_executable(tmpdir):
-    """Run a MapReduce job written in Bash."""
-    with tmpdir.as_cwd():
-        madoop.mapreduce(
-            input_path=TESTDATA_DIR/"word_count/input",
-            output_dir="output",
-            map_exe=TESTDATA_DIR/"word_count/map.sh",
-            reduce_exe=TESTDATA_DIR/"word_count/reduce.sh",
-            num_reducers=4,
-            partitioner=None,
-        )
+def test_2_reducers(tmp_path):
+    """Run a simple MapReduce job with 2 reducers."""
+    madoop.mapreduce(
+        input_path=TESTDATA_DIR/"word_count/input",
+        output_dir=tmp_path/"output",
+        map_exe=TESTDATA_DIR/"word_count/map.py",
+        reduce_exe=TESTDATA_DIR/"word_count/reduce.py",
+        num_reducers=2,
+        partitioner=None,
+    )
     utils.assert_dirs_eq(
-        TESTDATA_DIR/"word_count/correct/output",
-        tmpdir/"output",
+        TESTDATA_DIR/"word_count/correct/output-2-reducers",
+        tmp_path/"output",
     )
 
 
-def test_output_already_exists(tmpdir):
+def test_output_already_exists(tmp_path):
     """Output already existing should raise an error."""
-    with tmpdir.as_cwd(), pytest.raises(madoop.MadoopError):
+    with pytest.raises(madoop.MadoopError):
         madoop.mapreduce(
             input_path=TESTDATA_DIR/"word_count/input",
-            output_dir=tmpdir,
+            output_dir=tmp_path,
             map_exe=TESTDATA_DIR/"word_count/map.py",
             reduce_exe=TESTDATA_DIR/"word_count/reduce.py",
             num_reducers=2,
         )
 
 
-def test_bad_map_exe(tmpdir):
+def test_bad_map_exe(tmp_path):
     """Map exe returns non-zero should produce an error message."""
-    with tmpdir.as_cwd(), pytest.raises(madoop.MadoopError):
+    with pytest.raises(madoop.MadoopError):
         madoop.mapreduce(
             input_path=TESTDATA_DIR/"word_count/input",
-            output_dir="output",
+            output_dir=tmp_path/"output",
             map_exe=TESTDATA_DIR/"word_count/map_invalid.py",
             reduce_exe=TESTDATA_DIR/"word_count/reduce.py",
             num_reducers=4,
@@ -83,12 +125,12 @@ def test_bad_map_exe(tmpdir):
         )
 
 
-def test_bad_partition_exe(tmpdir):
+def test_bad_partition_exe(tmp_path):
     """Partition exe returns non-zero should produce an error message."""
-    with tmpdir.as_cwd(), pytest.raises(madoop.MadoopError):
+    with pytest.raises(madoop.MadoopError):
         madoop.mapreduce(
             input_path=TESTDATA_DIR/"word_count/input",
-            output_dir="output",
+            output_dir=tmp_path/"output",
             map_exe=TESTDATA_DIR/"word_count/map.py",
             reduce_exe=TESTDATA_DIR/"word_count/reduce.py",
             num_reducers=4,
@@ -96,115 +138,47 @@ def test_bad_partition_exe(tmpdir):
         )
 
 
-def test_noninteger_partition_exe(tmpdir):
+def test_noninteger_partition_exe(tmp_path):
     """Partition exe prints non-integer should produce an error message."""
-    with tmpdir.as_cwd(), pytest.raises(madoop.MadoopError):
+    with pytest.raises(madoop.MadoopError):
         madoop.mapreduce(
             input_path=TESTDATA_DIR/"word_count/input",
-            output_dir="output",
+            output_dir=tmp_path/"output",
             map_exe=TESTDATA_DIR/"word_count/map.py",
             reduce_exe=TESTDATA_DIR/"word_count/reduce.py",
             num_reducers=4,
             partitioner=TESTDATA_DIR/"word_count/partition_noninteger.py",
         )
 
-    with tmpdir.as_cwd(), pytest.raises(madoop.MadoopError):
+    with pytest.raises(madoop.MadoopError):
         map_stage(
             exe=TESTDATA_DIR/"word_count/map_invalid.py",
             input_dir=TESTDATA_DIR/"word_count/input",
-            output_dir=Path(tmpdir),
+            output_dir=tmp_path,
         )
 
 
-def test_bad_reduce_exe(tmpdir):
+def test_bad_reduce_exe(tmp_path):
     """Reduce exe returns non-zero should produce an error message."""
-    with tmpdir.as_cwd(), pytest.raises(madoop.MadoopError):
+    with pytest.raises(madoop.MadoopError):
         reduce_stage(
             exe=TESTDATA_DIR/"word_count/reduce_exit_1.py",
             input_dir=TESTDATA_DIR/"word_count/input",
-            output_dir=Path(tmpdir),
+            output_dir=tmp_path,
         )
 
+    # Reducer output files are removed when a reducer fails
+    assert not list(tmp_path.iterdir())
+
 
-def test_missing_shebang(tmpdir):
+def test_missing_shebang(tmp_path):
     """Reduce exe with a bad shebag should produce an error message."""
-    with tmpdir.as_cwd(), pytest.raises(madoop.MadoopError):
+    with pytest.raises(madoop.MadoopError):
         madoop.mapreduce(
             input_path=TESTDATA_DIR/"word_count/input",
-            output_dir="output",
+            output_dir=tmp_path/"output",
             map_exe=TESTDATA_DIR/"word_count/map.py",
             reduce_exe=TESTDATA_DIR/"word_count/reduce_invalid.py",
             num_reducers=4,
             partitioner=None,
         )
-
-
-def test_empty_inputs(tmpdir):
-    """Empty input files should not raise an error."""
-    with tmpdir.as_cwd():
-        madoop.mapreduce(
-            input_path=TESTDATA_DIR/"word_count/input_empty",
-            output_dir="output",
-            map_exe=TESTDATA_DIR/"word_count/map.py",
-            reduce_exe=TESTDATA_DIR/"word_count/reduce.py",
-            num_reducers=4,
-            partitioner=None,
-        )
-    utils.assert_dirs_eq(
-        TESTDATA_DIR/"word_count/correct/output",
-        tmpdir/"output",
-    )
-
-
-def test_single_input_file(tmpdir):
-    """Run a simple MapReduce job with an input file instead of dir."""
-    with tmpdir.as_cwd():
-        madoop.mapreduce(
-            input_path=TESTDATA_DIR/"word_count/input-single-file.txt",
-            output_dir="output",
-            map_exe=TESTDATA_DIR/"word_count/map.py",
-            reduce_exe=TESTDATA_DIR/"word_count/reduce.py",
-            num_reducers=4,
-            partitioner=None,
-        )
-    utils.assert_dirs_eq(
-        TESTDATA_DIR/"word_count/correct/output",
-        tmpdir/"output",
-    )
-
-
-def test_ignores_subdirs(tmpdir):
-    """Run a simple MapReduce job with an input directory containing a
-    subdirectory. The subdirectory should be gracefully ignored.
-    """
-    with tmpdir.as_cwd():
-        madoop.mapreduce(
-            input_path=TESTDATA_DIR/"word_count/input_with_subdir",
-            output_dir="output",
-            map_exe=TESTDATA_DIR/"word_count/map.py",
-            reduce_exe=TESTDATA_DIR/"word_count/reduce.py",
-            num_reducers=4,
-            partitioner=None,
-        )
-    utils.assert_dirs_eq(
-        TESTDATA_DIR/"word_count/correct/output",
-        tmpdir/"output",
-    )
-
-
-def test_input_path_spaces(tmpdir):
-    """Run a simple MapReduce job with an input directory containing a
-    subdirectory. The subdirectory should be gracefully ignored.
-    """
-    with tmpdir.as_cwd():
-        madoop.mapreduce(
-            input_path=TESTDATA_DIR/"word_count SPACE/input SPACE",
-            output_dir="output",
-            map_exe=TESTDATA_DIR/"word_count SPACE/map SPACE.py",
-            reduce_exe=TESTDATA_DIR/"word_count SPACE/reduce SPACE.py",
-            num_reducers=4
-        )
-    utils.assert_dirs_eq(
-        TESTDATA_DIR/"word_count/correct/output",
-        tmpdir/"output",
-    )
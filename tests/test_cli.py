@@ -1,19 +1,39 @@
 """System tests for the command line interface."""
+import logging
 import subprocess
 import importlib.metadata
 import pytest
+import madoop.__main__
 from . import utils
 from .utils import TESTDATA_DIR
 
 
+@pytest.fixture(name="root_logger")
+def fixture_root_logger():
+    """Restore the root logger after running main() in this process.
+
+    main() configures the root logger, which would otherwise leak handlers
+    into later tests.
+    """
+    root_logger = logging.getLogger()
+    handlers = list(root_logger.handlers)
+    level = root_logger.level
+    yield root_logger
+    for handler in list(root_logger.handlers):
+        if handler not in handlers:
+            root_logger.removeHandler(handler)
+    root_logger.setLevel(level)
+
+
 def test_version():
     """Verify --version flag."""
     result = subprocess.run(
         ["madoop", "--version"],
         stdout=subprocess.PIPE,
+        universal_newlines=True,
         check=True,
     )
-    output = result.stdout.decode("utf-8")
+    output = result.stdout
     assert "Madoop" in output
     assert importlib.metadata.version("madoop") in output
 
@@ -23,111 +43,121 @@ def test_help():
     result = subprocess.run(
         ["madoop", "--help"],
         stdout=subprocess.PIPE,
+        universal_newlines=True,
         check=True,
     )
-    output = result.stdout.decode("utf-8")
+    output = result.stdout
     assert "usage" in output
 
 
-def test_simple(tmpdir):
-    """Run a simple MapReduce job and verify the output."""
-    with tmpdir.as_cwd():
-        subprocess.run(
-            [
-                "madoop",
-                "-input", TESTDATA_DIR/"word_count/input",
-                "-output", "output",
-                "-mapper", TESTDATA_DIR/"word_count/map.py",
-                "-reducer", TESTDATA_DIR/"word_count/reduce.py",
-            ],
-            stdout=subprocess.PIPE,
-            check=True,
-        )
+@pytest.mark.usefixtures("root_logger")
+def test_simple(tmp_path):
+    """Run a simple MapReduce job and verify the output.
+
+    Call main() in this process to skip interpreter startup.  Other tests
+    cover the madoop console script.
+    """
+    madoop.__main__.main([
+        "-input", str(TESTDATA_DIR/"word_count/input"),
+        "-output", str(tmp_path/"output"),
+        "-mapper", str(TESTDATA_DIR/"word_count/map.py"),
+        "-reducer", str(TESTDATA_DIR/"word_count/reduce.py"),
+    ])
     utils.assert_dirs_eq(
         TESTDATA_DIR/"word_count/correct/output",
-        tmpdir/"output",
+        tmp_path/"output",
     )
 
 
-def test_2_reducers(tmpdir):
+@pytest.mark.usefixtures("root_logger")
+def test_2_reducers(tmp_path):
     """Run a simple MapReduce job with 2 reducers."""
-    with tmpdir.as_cwd():
-        subprocess.run(
-            [
-                "madoop",
-                "-input", TESTDATA_DIR/"word_count/input",
-                "-output", "output",
-                "-mapper", TESTDATA_DIR/"word_count/map.py",
-                "-reducer", TESTDATA_DIR/"word_count/reduce.py",
-                "-numReduceTasks", "2",
-            ],
-            stdout=subprocess.PIPE,
-            check=True,
-        )
+    madoop.__main__.main([
+        "-input", str(TESTDATA_DIR/"word_count/input"),
+        "-output", str(tmp_path/"output"),
+        "-mapper", str(TESTDATA_DIR/"word_count/map.py"),
+        "-reducer", str(TESTDATA_DIR/"word_count/reduce.py"),
+        "-numReduceTasks", "2",
+    ])
     utils.assert_dirs_eq(
         TESTDATA_DIR/"word_count/correct/output-2-reducers",
-        tmpdir/"output",
+        tmp_path/"output",
     )
 
 
-def test_verbose(tmpdir):
-    """Run a simple MapReduce job and verify the verbose stdout."""
-    with tmpdir.as_cwd():
-        completed_process = subprocess.run(
-            [
-                "madoop",
-                "--verbose",
-                "-input", TESTDATA_DIR/"word_count/input",
-                "-output", "output",
-                "-mapper", TESTDATA_DIR/"word_count/map.py",
-                "-reducer", TESTDATA_DIR/"word_count/reduce.py",
-            ],
-            stdout=subprocess.PIPE,
-            universal_newlines=True,
-            check=True,
-        )
-    stdout_lines = completed_process.stdout.strip().split("\n")
-    any(i.startswith("INFO") for i in stdout_lines)
-    any(i.startswith("DEBUG") for i in stdout_lines)
-    assert len(stdout_lines) > 20
+@pytest.mark.usefixtures("root_logger")
+def test_verbose(tmp_path, caplog):
+    """Run a simple MapReduce job and verify the verbose log output."""
+    madoop.__main__.main([
+        "--verbose",
+        "-input", str(TESTDATA_DIR/"word_count/input"),
+        "-output", str(tmp_path/"output"),
+        "-mapper", str(TESTDATA_DIR/"word_count/map.py"),
+        "-reducer", str(TESTDATA_DIR/"word_count/reduce.py"),
+    ])
+    levels = [record.levelno for record in caplog.records]
+    assert logging.INFO in levels
+    assert logging.DEBUG in levels
+    assert len(levels) > 20
+
+
+@pytest.mark.usefixtures("root_logger")
+def test_combiner(tmp_path, caplog):
+    """Run a simple MapReduce job with a combiner."""
+    madoop.__main__.main([
+        "--verbose",
+        "-input", str(TESTDATA_DIR/"word_count/input"),
+        "-output", str(tmp_path/"output"),
+        "-mapper", str(TESTDATA_DIR/"word_count/map.py"),
+        "-reducer", str(TESTDATA_DIR/"word_count/reduce.py"),
+        "-combiner", str(TESTDATA_DIR/"word_count/combine.py"),
+    ])
+    assert any(
+        "with combine.py" in record.getMessage() for record in caplog.records
+    )
+    utils.assert_dirs_eq(
+        TESTDATA_DIR/"word_count/correct/output",
+        tmp_path/"output",
+    )
 
 
-def test_hadoop_arguments(tmpdir):
+@pytest.mark.usefixtures("root_logger")
+def test_hadoop_arguments(tmp_path):
     """Hadoop Streaming arguments should be ignored."""
-    with tmpdir.as_cwd():
-        subprocess.run(
-            [
-                "madoop",
-                "jar", "hadoop-streaming-2.7.2.jar",  # Hadoop args
-                "-input", TESTDATA_DIR/"word_count/input",
-                "-output", "output",
-                "-mapper", TESTDATA_DIR/"word_count/map.py",
-                "-reducer", TESTDATA_DIR/"word_count/reduce.py",
-            ],
-            stdout=subprocess.PIPE,
-            check=True,
-        )
+    madoop.__main__.main([
+        "jar", "hadoop-streaming-2.7.2.jar",  # Hadoop args
+        "-input", str(TESTDATA_DIR/"word_count/input"),
+        "-output", str(tmp_path/"output"),
+        "-mapper", str(TESTDATA_DIR/"word_count/map.py"),
+        "-reducer", str(TESTDATA_DIR/"word_count/reduce.py"),
+    ])
+    utils.assert_dirs_eq(
+        TESTDATA_DIR/"word_count/correct/output",
+        tmp_path/"output",
+    )
 
 
-def test_example(tmpdir):
+def test_example(tmp_path):
     """Example option should copy files."""
-    with tmpdir.as_cwd():
-        subprocess.run(
-            ["madoop", "--example"],
-            check=True,
-            stderr=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-        )
-    assert (tmpdir/"example/input/input01.txt").exists()
-    assert (tmpdir/"example/input/input02.txt").exists()
-    assert (tmpdir/"example/map.py").exists()
-    assert (tmpdir/"example/reduce.py").exists()
+    subprocess.run(
+        ["madoop", "--example"],
+        cwd=tmp_path,
+        check=True,
+        stderr=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+    )
+    assert (tmp_path/"example/input/input01.txt").exists()
+    assert (tmp_path/"example/input/input02.txt").exists()
+    assert (tmp_path/"example/map.py").exists()
+    assert (tmp_path/"example/reduce.py").exists()
+    assert (tmp_path/"example/combine.py").exists()
 
     # Call it again and it should refuse to clobber
-    with tmpdir.as_cwd(), pytest.raises(subprocess.CalledProcessError):
+    with pytest.raises(subprocess.CalledProcessError):
         subprocess.run(
             ["madoop", "--example"],
+            cwd=tmp_path,
             check=True,
-            stderr=subprocess.PIPE,
-            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
         )
@@ -1,109 +1,186 @@
 """System tests for the map stage of Michigan Hadoop."""
+import collections
+import errno
+import concurrent.futures
+import hashlib
+import importlib
+import os
 import shutil
+import subprocess
 from pathlib import Path
+import pytest
+from madoop.exceptions import MadoopError
 from madoop.mapreduce import (
+    combine_single_file,
+    copy_file_range,
+    is_executable,
     map_stage,
     group_stage,
+    input_split_size,
+    keyhash,
     reduce_stage,
     split_file,
-    MAX_INPUT_SPLIT_SIZE,
+    wait_for_futures,
+    MIN_INPUT_SPLIT_SIZE,
 )
 from . import utils
 from .utils import TESTDATA_DIR
 
 
-def test_map_stage(tmpdir):
+def test_map_stage(tmp_path):
     """Test the map stage using word count example."""
     map_stage(
         exe=TESTDATA_DIR/"word_count/map.py",
         input_dir=TESTDATA_DIR/"word_count/input",
-        output_dir=Path(tmpdir),
+        output_dir=tmp_path,
     )
     utils.assert_dirs_eq(
         TESTDATA_DIR/"word_count/correct/mapper-output",
-        tmpdir,
+        tmp_path,
     )
 
 
-def test_group_stage(tmpdir):
+@pytest.mark.parametrize("spill", [False, True], ids=["in-memory", "spill"])
+def test_map_stage_combiner(tmp_path, monkeypatch, spill):
+    """Test that the map stage combines the output of each mapper."""
+    if spill:
+        # Sort mapper output one line at a time, spilling to run files
+        module = importlib.import_module("madoop.mapreduce")
+        monkeypatch.setattr(module, "MAX_SORT_IN_MEMORY_SIZE", 1)
+    map_stage(
+        exe=TESTDATA_DIR/"word_count/map.py",
+        input_dir=TESTDATA_DIR/"word_count/input",
+        output_dir=tmp_path,
+        combiner=TESTDATA_DIR/"word_count/combine.py",
+    )
+
+    # Each output has one line per key, with the counts that the uncombined
+    # mapper output adds up to
+    correct_dir = TESTDATA_DIR/"word_count/correct/mapper-output"
+    correct_paths = sorted(correct_dir.iterdir())
+    output_paths = sorted(tmp_path.iterdir())
+    assert all(path.is_file() for path in output_paths)
+    assert len(output_paths) == len(correct_paths)
+    for correct_path, output_path in zip(correct_paths, output_paths):
+        expected = collections.Counter()
+        for line in correct_path.read_text(encoding="utf-8").splitlines():
+            key, _, value = line.partition("\t")
+            expected[key] += int(value)
+        lines = output_path.read_text(encoding="utf-8").splitlines()
+        assert lines == sorted(lines)
+        assert lines == [f"{key}\t{expected[key]}" for key in sorted(expected)]
+
+
+def test_combiner_exits_early(tmp_path):
+    """Test a combiner that succeeds without reading all of its input."""
+    # More mapper output than fits in the combiner's pipe
+    path = tmp_path/"part-00000"
+    path.write_bytes(b"".join(
+        f"{i:06d}\t1\n".encode() for i in range(400000)
+    ))
+    combine_single_file(TESTDATA_DIR/"word_count/combine_first_line.py", path)
+    assert path.read_bytes() == b"000000\t1\n"
+
+
+@pytest.mark.parametrize(
+    "num_reducers, partitioner, correct_dir",
+    [
+        pytest.param(4, None, "grouper-output", id="4-reducers"),
+        pytest.param(
+            2, None, "grouper-output-2-reducers", id="2-reducers",
+        ),
+        pytest.param(
+            2,
+            TESTDATA_DIR/"word_count/partition.py",
+            "grouper-output-custom-partitioner",
+            id="custom-partitioner",
+        ),
+    ],
+)
+def test_group_stage(tmp_path, num_reducers, partitioner, correct_dir):
     """Test group stage using word count example."""
     group_stage(
         input_dir=TESTDATA_DIR/"word_count/correct/mapper-output",
-        output_dir=Path(tmpdir),
-        num_reducers=4,
-        partitioner=None,
+        output_dir=tmp_path,
+        num_reducers=num_reducers,
+        partitioner=partitioner,
     )
     utils.assert_dirs_eq(
-        TESTDATA_DIR/"word_count/correct/grouper-output",
-        tmpdir,
+        TESTDATA_DIR/"word_count/correct"/correct_dir,
+        tmp_path,
     )
 
 
-def test_group_stage_2_reducers(tmpdir):
-    """Test group stage using word count example with 2 reducers."""
+def test_group_stage_large_input(tmp_path, monkeypatch):
+    """Test group stage with input too large to partition in memory."""
+    # madoop.mapreduce is shadowed by the mapreduce() function
+    module = importlib.import_module("madoop.mapreduce")
+    monkeypatch.setattr(module, "MAX_SORT_IN_MEMORY_SIZE", 0)
     group_stage(
         input_dir=TESTDATA_DIR/"word_count/correct/mapper-output",
-        output_dir=Path(tmpdir),
-        num_reducers=2,
+        output_dir=tmp_path,
+        num_reducers=4,
         partitioner=None,
     )
     utils.assert_dirs_eq(
-        TESTDATA_DIR/"word_count/correct/grouper-output-2-reducers",
-        tmpdir,
+        TESTDATA_DIR/"word_count/correct/grouper-output",
+        tmp_path,
     )
 
 
-def test_group_stage_custom_partitioner(tmpdir):
-    """Test group stage using word count example with custom partitioner."""
+def test_group_stage_3_reducers(tmp_path):
+    """Test group stage with a number of reducers that isn't a power of 2."""
     group_stage(
         input_dir=TESTDATA_DIR/"word_count/correct/mapper-output",
-        output_dir=Path(tmpdir),
-        num_reducers=2,
-        partitioner=TESTDATA_DIR/"word_count/partition.py",
-    )
-    utils.assert_dirs_eq(
-        TESTDATA_DIR/"word_count/correct/grouper-output-custom-partitioner",
-        tmpdir,
+        output_dir=tmp_path,
+        num_reducers=3,
+        partitioner=None,
     )
+    for num in range(3):
+        path = tmp_path/f"part-{num:05d}"
+        lines = path.read_bytes().splitlines() if path.exists() else []
+        assert lines == sorted(lines)
+        for line in lines:
+            assert keyhash(line.partition(b"\t")[0]) % 3 == num
 
 
-def test_reduce_stage(tmpdir):
+@pytest.mark.parametrize(
+    "input_dir, correct_dir",
+    [
+        pytest.param("grouper-output", "reducer-output", id="4-reducers"),
+        pytest.param(
+            "grouper-output-2-reducers", "reducer-output-2-reducers",
+            id="2-reducers",
+        ),
+    ],
+)
+def test_reduce_stage(tmp_path, input_dir, correct_dir):
     """Test reduce stage using word count example."""
     reduce_stage(
         exe=TESTDATA_DIR/"word_count/reduce.py",
-        input_dir=TESTDATA_DIR/"word_count/correct/grouper-output",
-        output_dir=Path(tmpdir),
-    )
-    utils.assert_dirs_eq(
-        TESTDATA_DIR/"word_count/correct/reducer-output",
-        tmpdir,
-    )
-
-
-def test_reduce_stage_2_reducers(tmpdir):
-    """Test reduce stage using word count example with 2 reducers."""
-    reduce_stage(
-        exe=TESTDATA_DIR/"word_count/reduce.py",
-        input_dir=TESTDATA_DIR/"word_count/correct/grouper-output-2-reducers",
-        output_dir=Path(tmpdir),
+        input_dir=TESTDATA_DIR/"word_count/correct"/input_dir,
+        output_dir=tmp_path,
     )
     utils.assert_dirs_eq(
-        TESTDATA_DIR/"word_count/correct/reducer-output-2-reducers",
-        tmpdir,
+        TESTDATA_DIR/"word_count/correct"/correct_dir,
+        tmp_path,
     )
 
 
 def test_input_splitting(tmp_path):
     """Test that the Map Stage correctly splits input."""
-    input_data = "o" * (MAX_INPUT_SPLIT_SIZE - 10) + "\n" + \
-        "a" * int(MAX_INPUT_SPLIT_SIZE / 2)
+    line1 = b"o" * (MIN_INPUT_SPLIT_SIZE - 10) + b"\n"
+    line2 = b"a" * (MIN_INPUT_SPLIT_SIZE // 2)
     input_dir = tmp_path/"input"
     output_dir = tmp_path/"output"
     input_dir.mkdir()
     output_dir.mkdir()
 
-    with open(input_dir/"input.txt", "w", encoding="utf-8") as input_file:
-        input_file.write(input_data)
+    # Write bytes directly, one line at a time, to avoid building and
+    # encoding one large string
+    with open(input_dir/"input.txt", "wb") as input_file:
+        input_file.write(line1)
+        input_file.write(line2)
 
     map_stage(
         exe=Path(shutil.which("cat")),
@@ -114,13 +191,15 @@ def test_input_splitting(tmp_path):
     output_files = sorted(output_dir.glob("*"))
     assert len(output_files) == 2
     assert output_files == [output_dir/"part-00000", output_dir/"part-00001"]
+    assert (output_dir/"part-00000").read_bytes() == line1
+    assert (output_dir/"part-00001").read_bytes() == line2
+
 
-    with open(output_dir/"part-00000", "r", encoding="utf-8") as outfile1:
-        data = outfile1.read()
-        assert data == "o" * (MAX_INPUT_SPLIT_SIZE - 10) + "\n"
-    with open(output_dir/"part-00001", "r", encoding="utf-8") as outfile2:
-        data = outfile2.read()
-        assert data == "a" * int(MAX_INPUT_SPLIT_SIZE / 2)
+def test_input_split_size():
+    """Test that split size grows with the square root of large inputs."""
+    assert input_split_size(0) == MIN_INPUT_SPLIT_SIZE
+    assert input_split_size(10 * MIN_INPUT_SPLIT_SIZE) == MIN_INPUT_SPLIT_SIZE
+    assert input_split_size(10**12) == 10**9
 
 
 def test_split_file_mid_chunk(tmp_path):
@@ -131,4 +210,67 @@ def test_split_file_mid_chunk(tmp_path):
         infile.write(input_data)
 
     splits = list(split_file(input_file, 50))
-    assert splits == [b"noah says\n", b"hello world"]
+    assert splits == [(0, 10), (10, 11)]
+
+
+def test_split_file_long_line(tmp_path):
+    """Test that a line longer than the chunk size isn't split."""
+    input_file = tmp_path/"input.txt"
+    input_file.write_bytes(b"hello world\nbye\n")
+    splits = list(split_file(input_file, 5))
+    assert splits == [(0, 12), (12, 4)]
+
+
+def test_copy_file_range_fallback(tmp_path, monkeypatch):
+    """Test copying part of a file when os.sendfile() isn't supported."""
+    def sendfile(*_):
+        raise OSError(errno.ENOTSOCK, os.strerror(errno.ENOTSOCK))
+    monkeypatch.setattr(os, "sendfile", sendfile)
+    input_file = tmp_path/"input.txt"
+    input_file.write_bytes(b"noah says\nhello world")
+    output_file = tmp_path/"output.txt"
+    with input_file.open("rb") as infile, output_file.open("wb") as outfile:
+        copy_file_range(infile, outfile, 10, 5)
+    assert output_file.read_bytes() == b"hello"
+
+
+def test_keyhash():
+    """Test that keyhash matches the integer value of the MD5 hex digest."""
+    for key in [b"", b"hello", "Göteborg".encode("utf-8")]:
+        hexdigest = hashlib.md5(key).hexdigest()
+        assert keyhash(key) == int(hexdigest, base=16)
+
+
+def test_is_executable_cached(tmp_path, monkeypatch):
+    """Test that an unchanged executable is only test-executed once."""
+    # Losing the executable bit invalidates the cached result
+    exe = tmp_path/"map.py"
+    shutil.copy(TESTDATA_DIR/"word_count/map.py", exe)
+    is_executable(exe)
+    exe.chmod(0o644)
+    with pytest.raises(MadoopError):
+        is_executable(exe)
+
+    is_executable(TESTDATA_DIR/"word_count/map.py")
+
+    def run(*_, **__):
+        raise subprocess.CalledProcessError(1, "map.py")
+    monkeypatch.setattr(subprocess, "run", run)
+    is_executable(TESTDATA_DIR/"word_count/map.py")
+
+
+def test_split_file_empty(tmp_path):
+    """Test that an empty file has no chunks."""
+    input_file = tmp_path/"input.txt"
+    input_file.write_bytes(b"")
+    assert not list(split_file(input_file, 5))
+
+
+def test_wait_for_futures_cancels():
+    """Test that pending futures are cancelled after the first failure."""
+    failed = concurrent.futures.Future()
+    failed.set_exception(MadoopError("fail"))
+    pending = concurrent.futures.Future()
+    with pytest.raises(MadoopError):
+        wait_for_futures([failed, pending])
+    assert pending.cancelled()
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""Word count combiner."""
+import sys
+import itertools
+
+
+def main():
+    """Sum the counts of each group of lines that share a key."""
+    for key, group in itertools.groupby(sys.stdin, keyfunc):
+        word_count = 0
+        for line in group:
+            word_count += int(line.partition("\t")[2])
+        print(f"{key}\t{word_count}")
+
+
+def keyfunc(line):
+    """Return the key from a TAB-delimited key-value pair."""
+    return line.partition("\t")[0]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+"""Combiner that exits successfully after reading only one line."""
+
+import sys
+
+sys.stdout.write(sys.stdin.readline())
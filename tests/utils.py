@@ -1,5 +1,5 @@
 """Unit test utilities."""
-import filecmp
+import os
 import pathlib
 
 
@@ -15,11 +15,12 @@ def assert_dirs_eq(dir1, dir2):
         f"dir2 = {dir2}\n"
     )
 
-    # Get a list of files in each directory
-    dir1 = pathlib.Path(dir1)
-    dir2 = pathlib.Path(dir2)
-    paths1 = list(dir1.iterdir())
-    paths2 = list(dir2.iterdir())
+    # Get a sorted list of files in each directory.  DirEntry caches the file
+    # type from the directory listing, so is_file() doesn't need a stat().
+    with os.scandir(dir1) as entries:
+        paths1 = sorted(entries, key=lambda entry: entry.name)
+    with os.scandir(dir2) as entries:
+        paths2 = sorted(entries, key=lambda entry: entry.name)
 
     # Sanity checks
     assert paths1, f"Empty directory: {dir1}"
@@ -34,9 +35,12 @@ def assert_dirs_eq(dir1, dir2):
         f"number of files in dir2 = {len(paths2)}\n"
     )
 
-    # Compare files pairwise
-    for path1, path2 in zip(sorted(paths1), sorted(paths2)):
-        assert filecmp.cmp(path1, path2, shallow=False), (
+    # Compare files pairwise.  Test data files are small, so read each one
+    # with a single call instead of comparing them block by block.
+    for path1, path2 in zip(paths1, paths2):
+        path1 = pathlib.Path(path1)
+        path2 = pathlib.Path(path2)
+        assert path1.read_bytes() == path2.read_bytes(), (
             "Files do not match:\n"
             f"path1 = {path1}\n"
             f"path2 = {path2}\n"